@@ -17,6 +17,58 @@ try:
     import numpy as np
 except ImportError:
     raise NotImplementedError('numpy is required')
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None                 # optional, falls back to numpy
+
+# tuner synthesizer dividers: Fc = tcxo * r / n, r in [10,129], n in [1,31]
+_TUNER_R_MIN, _TUNER_R_MAX = 10, 129
+_TUNER_N = np.arange(1,32)
+_TUNER_CACHE_SIZE = 2048
+_tuner_cache = {}
+
+def _nearest_tuner(frequency, tcxo):
+    '''Return the (r,n) dividers that synthesize the closest frequency to the request.'''
+    key = (frequency, tcxo)
+    try:
+        return _tuner_cache[key]
+    except KeyError:
+        pass
+    # for each n the best r is the nearest integer to n*frequency/tcxo
+    r = np.clip(np.rint(_TUNER_N * (frequency/tcxo)), _TUNER_R_MIN, _TUNER_R_MAX)
+    e = np.abs(r/_TUNER_N - frequency/tcxo)
+    i = e.argmin()
+    rn = (int(r[i]), int(_TUNER_N[i]))
+    if len(_tuner_cache) >= _TUNER_CACHE_SIZE:
+        _tuner_cache.clear()
+    _tuner_cache[key] = rn
+    return rn
+
+# 12-bit ADC code to [-1,+1]
+_IQ_SCALE = np.float32(2.0/4095)
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _unpack_iq(b, re, im, ri, otm_polarity):
+        '''Single pass unpack of an IQ stream into re/im, returning (polarity_ok, otm_index).'''
+        n = len(b)//2
+        qi = 1 - ri
+        bad = 0
+        first = n                   # first sample carrying the OTM
+        pol = 1 if otm_polarity else 0
+        # branch-free body so LLVM can vectorize the loop (SIMD)
+        for i in prange(n):
+            wr = b[2*i+ri]
+            wq = b[2*i+qi]
+            re[i] = (wr & 0xFFF) * _IQ_SCALE - 1.0
+            im[i] = (wq & 0xFFF) * _IQ_SCALE - 1.0
+            bad += ((wr >> 12) & 1) + (((wq >> 12) & 1) ^ 1)
+            hit = (((b[2*i] >> 15) & 1) ^ pol) | (((b[2*i+1] >> 15) & 1) ^ pol)
+            first = min(first, i if hit else n)
+        return bad == 0, (first if first < n else -1)
+else:
+    _unpack_iq = None
 
 class RASDRException(Exception):
     """Base Exception class for the RASDR module"""
@@ -27,10 +79,24 @@ class PolarityException(RASDRException):
 class ParameterError(RASDRException):
     """A parameter exceeds defined limits"""
 
-# http://stackoverflow.com/questions/4984647/accessing-dict-keys-like-an-attribute-in-python
-class AttributeDict(dict):
-    __getattr__ = dict.__getitem__
-    __setattr__ = dict.__setitem__
+class RASDRState(object):
+    """Receiver configuration, held in slots for fast attribute access"""
+    __slots__ = ('instance', 'channel', 'open', 'simulation', 'gain', 'fc',
+                 'sr', 'sps', 'bw', 'samples', 'tcxo', 'tuner')
+
+    def __init__(self, gain, fc, sr, bw, samples, tcxo):
+        self.instance = None
+        self.channel = None
+        self.open = False
+        self.simulation = False
+        self.gain = list(gain)
+        self.fc = fc
+        self.sr = sr                # samples-per-second
+        self.sps = (1.0/sr)         # seconds-per-sample
+        self.bw = bw
+        self.samples = samples
+        self.tcxo = tcxo
+        self.tuner = { 'r':10, 'n':1 }
 
 class BaseRASDR(object):
     DEFAULT_GAIN = [ 6.0, 25.17, 0.0 ]
@@ -39,28 +105,16 @@ class BaseRASDR(object):
     DEFAULT_BW = 1.5e6          # Hz
     DEFAULT_SAMPLES = 2048      # samples
     REFERENCE_FREQ = 30.72e6    # TCXO synthesizer
+    LNA_GAIN = ( 0.0, 3.0, 6.0 ) # dB: bypass, midgain, maxgain
 
     gain_values = []
     valid_gains_db = []
     buffer = []
     num_bytes_read = 0
     
-    state = AttributeDict({
-        'instance':None,
-        'channel':None,
-        'open':False,
-        'simulation':False,
-        'gain':DEFAULT_GAIN,
-        'fc':DEFAULT_FC,
-        'sr':DEFAULT_SR,        # samples-per-second
-        'sps':(1.0/DEFAULT_SR), # seconds-per-sample
-        'bw':DEFAULT_BW,
-        'samples':DEFAULT_SAMPLES,
-        'tcxo':REFERENCE_FREQ,
-        'tuner': { 'r':10, 'n':1 },
-        })
-
     def __init__(self, instance=0, channel=0, simulation=False):
+        self.state = RASDRState(self.DEFAULT_GAIN, self.DEFAULT_FC, self.DEFAULT_SR,
+                                self.DEFAULT_BW, self.DEFAULT_SAMPLES, self.REFERENCE_FREQ)
         self.open(instance, channel, simulation)
 
     def __str__(self):
@@ -90,6 +144,7 @@ class BaseRASDR(object):
         self.state.channel = 0
         self.state.simulation = simulation
         self.state.open = True
+        self._scratch = {}          # unpack work buffers for the last sample count
 
     def close(self):
         '''Shutdown RASDR object and release resources.'''
@@ -115,11 +170,13 @@ class BaseRASDR(object):
         :param frequency: A numeric or string representing the tuning frequency in Hz
         
         Use _get_center_freq() to see the precise frequency used.
+
+        May raise a ParameterError exception if the frequency is not finite.
         '''
-        a = [ (r,n) for r in range(10,130,1) for n in range(1,32) ]
-        f = [ (self.state.tcxo * r)/n for r,n in a ]
-        e = np.square(np.subtract(np.array(f),frequency))
-        (r,n) = a[e.argmin()]
+        f = float(frequency)
+        if not np.isfinite(f):
+            raise ParameterError('{} is not a valid frequency'.format(f))
+        (r,n) = _nearest_tuner(f, self.state.tcxo)
         self.state.tuner['r'] = r
         self.state.tuner['n'] = n
         self.state.fc = (self.state.tcxo * r) / n
@@ -128,6 +185,27 @@ class BaseRASDR(object):
         '''Return center frequency of tuner (in Hz).'''
         return self.state.fc
 
+    def _set_reference_freq(self, frequency):
+        '''
+        Set the calibrated frequency of the TCXO reference.
+
+        :param frequency: A numeric or string representing the reference frequency in Hz
+
+        The tuner is re-solved so that the center frequency stays as close as possible
+        to its previous value.
+
+        May raise a ParameterError exception if the frequency is not positive and finite.
+        '''
+        f = float(frequency)
+        if not (0.0 < f < float('inf')):
+            raise ParameterError('{} is not a valid reference frequency'.format(f))
+        self.state.tcxo = f
+        self._set_center_freq(self.state.fc)
+
+    def _get_reference_freq(self):
+        '''Return frequency of the TCXO reference (in Hz).'''
+        return self.state.tcxo
+
     def _set_sample_rate(self, rate):
         '''
         Set sample rate of the channel.
@@ -139,7 +217,7 @@ class BaseRASDR(object):
         May raise a ParameterError exception if device limits are exceeded.
         '''
         r = float(rate)
-        if r < 1e6 or r > 32e6:
+        if not (1e6 <= r <= 32e6):
             raise ParameterError('{:.0f} exceeds limit of [{:.0e},{:.0e}]'.format(r,1e6,32e6))
         self.state.sr = r
         self.state.sps = (1.0/r)
@@ -159,7 +237,7 @@ class BaseRASDR(object):
         May raise a ParameterError exception if device limits are exceeded.
         '''
         bw = float(bandwidth)
-        if bw < 0.75e6 or bw > 28e6:
+        if not (0.75e6 <= bw <= 28e6):
             raise ParameterError('{:.0f} exceeds limit of [{:.0e},{:.0e}]'.format(bw,0.75e6,28e6))
         self.state.bw = bw
 
@@ -189,84 +267,165 @@ class BaseRASDR(object):
         May raise a ParameterError exception if device limits are exceeded.
         '''
         g = float(gain)
-        if g < 0.0 or g > 61.17:
+        if not (0.0 <= g <= 61.17):
             raise ParameterError('{:.0f} exceeds limit of [{:.0e},{:.0e}]'.format(g,0.0,61.17))
         ga = [ 0.0, 0.0, 0.0 ]
-        # compute LNA gain (0.0=bypass, 3.0=midgain, 6.0=maxgain)
-        if g>3.0:
-            ga[0] = 6.0
-        else:
-            ga[0] = 3.0 if g>0.0 else 0.0
+        # compute LNA gain, the largest step not exceeding the request
+        ga[0] = self.LNA_GAIN[(g>=3.0) + (g>=6.0)]
         g -= ga[0]
-        # compute VGA1 gain
-        if g>25.17:
-            ga[1] = 25.17
-        else:
-            ga[1] = g   # TODO: there is a table of fixed values
+        # compute VGA1 gain, clamped to [0,25.17]
+        ga[1] = min(25.17, max(0.0, g))     # TODO: there is a table of fixed values
         g -= ga[1]
-        # compute VGA2 gain
-        if g>30.0:
-            ga[2] = 30.0
-        else:
-            ga[2] = float(int(g/3.0)*3)
+        # compute VGA2 gain, 3dB steps clamped to [0,30]
+        ga[2] = min(30.0, float(int(max(0.0, g)/3.0)*3))
         self.state.gain = ga
 
     def _get_gain(self):
         '''Return gain of the receiver (in dB).'''
-        gain = 0.0
-        for g in self.state.gain:
-            gain += g
-        return gain
+        ga = self.state.gain        # LNA, VGA1, VGA2
+        return ga[0] + ga[1] + ga[2]
 
     def read(self, n=(DEFAULT_SAMPLES*2*2)):
         raise NotImplementedError('TODO')
     def read_samples(self, n=DEFAULT_SAMPLES):
-        raise NotImplementedError('TODO')
+        '''Read n samples from the receiver into a new complex64 numpy array.'''
+        iq = np.empty(n, np.complex64)
+        return iq[:self.read_samples_into(iq)[0]]
+
+    def read_samples_into(self, out, iq_polarity=False, otm_polarity=False):
+        '''
+        Read samples from the receiver into a preallocated array.
+
+        :param out: A complex64 numpy array to fill, its length is the number of samples requested
+        :option iq_polarity: A boolean indicating the order of IQ (False) or QI (True)
+        :option otm_polarity: A boolean indicating the polarity of the PPS input
+        :returns: A tuple of the number of samples read into the front of out, and the
+            OTM sample offset and time offset as returned by _packed_bytes_to_iq()
+
+        Reusing one buffer across calls avoids a per-call allocation when streaming.
+        A short read fills only the front of out, and the offsets refer to that part.
+        '''
+        buf = self.read(len(out)*2*2)
+        n = len(buf)//(2*2)
+        _, otm_index, offset = self._packed_bytes_to_iq_into(buf[:n*2*2], out[:n],
+                                                             iq_polarity, otm_polarity)
+        return n, otm_index, offset
 
     def _packed_bytes_to_iq(self, bytes, iq_polarity=False, otm_polarity=False):
         '''
         Unpack array of bytes to numpy array of complex numbers.
 
-        :param bytes: A buffer-like object containing packed IQ data with control bits
+        :param bytes: A buffer-like object or numpy array (e.g. from np.fromfile or
+            np.memmap) containing packed IQ data with control bits
         :option iq_polarity: A boolean indicating the order of IQ (False) or QI (True)
         :option otm_polarity: A boolean indicating the polarity of the PPS input
-        :returns: A tuple representing a numpy array of complex values, the sample
+        :returns: A tuple representing a numpy array of complex64 values, the sample
             offset of the OTM (or -1 if not found), the time offset (in seconds) from
             the *END* of the buffer that the OTM marker occured.
 
         The function will strip control bits from a raw data stream obtained from a
-        RASDR2/3 receiver and return a complex numpy array with the samples arranged
-        in the correct order.  The function will also analyze the control bits in the
-        stream for the on-time-marker (OTM) or pulse-per-second input that was sampled
-        along with the stream.
+        RASDR2/3 receiver and return a complex64 numpy array with the samples arranged
+        in the correct order.  Single precision is ample for the 12-bit ADC and halves
+        the memory traffic of downstream consumers (FFT, file writes).  The function
+        will also analyze the control bits in the stream for the on-time-marker (OTM)
+        or pulse-per-second input that was sampled along with the stream.
+        '''
+        b = self._packed_bytes(bytes)
+        return self._packed_bytes_to_iq_into(b, np.empty(len(b)//2, np.complex64),
+                                             iq_polarity, otm_polarity)
+
+    def _packed_bytes_to_iq_batch(self, chunks, iq_polarity=False, otm_polarity=False):
         '''
-        b = np.frombuffer(bytes,dtype='<i2')
-        iq = np.empty(len(b)//2, 'complex')
+        Unpack a sequence of buffers as one contiguous stream.
+
+        :param chunks: A non-empty sequence of buffer-like objects or numpy arrays, each
+            holding whole IQ pairs
+        :option iq_polarity: A boolean indicating the order of IQ (False) or QI (True)
+        :option otm_polarity: A boolean indicating the polarity of the PPS input
+        :returns: The same tuple as _packed_bytes_to_iq(), covering the concatenated stream
+            (the OTM sample offset counts from the start of the first chunk)
+
+        Joining the chunks first lets the whole stream be unpacked in a single call,
+        rather than paying the per-call overhead once for every buffer.
+
+        May raise a ParameterError exception if chunks is empty.
+        '''
+        if not len(chunks):
+            raise ParameterError('at least one buffer is required')
+        b = np.concatenate([self._packed_bytes(c) for c in chunks])
+        return self._packed_bytes_to_iq(b, iq_polarity, otm_polarity)
+
+    def _packed_bytes(self, bytes):
+        '''Return a little-endian int16 view of a buffer-like object or numpy array.'''
+        if isinstance(bytes, np.ndarray):
+            # no copy for contiguous (e.g. file-backed) arrays, strided input is compacted
+            # and any shape (e.g. one row per IQ pair) is flattened to a single stream
+            return np.ascontiguousarray(bytes).reshape(-1).view('<i2')
+        return np.frombuffer(bytes,dtype='<i2')
+
+    def _packed_bytes_to_iq_into(self, bytes, iq, iq_polarity=False, otm_polarity=False):
+        '''
+        Unpack array of bytes into a preallocated numpy array of complex numbers.
+
+        :param bytes: As for _packed_bytes_to_iq()
+        :param iq: A complex64 numpy array of half the number of 16-bit words in bytes
+        :option iq_polarity: A boolean indicating the order of IQ (False) or QI (True)
+        :option otm_polarity: A boolean indicating the polarity of the PPS input
+        :returns: The same tuple as _packed_bytes_to_iq(), with iq as the sample array
+
+        May raise a ParameterError exception if iq is not sized to match bytes.
+        '''
+        b = self._packed_bytes(bytes)
+        if len(iq) != len(b)//2:
+            raise ParameterError('{} samples do not fit {} IQ pairs'.format(len(iq),len(b)//2))
         if iq_polarity:
             ri = 1                  # QIQIQI...
             qi = 0
         else:
             ri = 0                  # IQIQIQ...
             qi = 1
-        re = b[ri::2] & 0x1000      # in-phase samples
-        im = b[qi::2] & 0x1000      # quadrature samples
-        otm = b & 0x8000            # on-time-marker
-        iq.real = b[ri::2] & 0xFFF  # strip control bits
-        iq.imag = b[qi::2] & 0xFFF  # "
-        if re.max()>0 or im.min()<1:
+        if _unpack_iq is not None:
+            polarity_ok, otm_index = _unpack_iq(b, iq.real, iq.imag, ri, otm_polarity)
+        else:
+            # each IQ pair is one little-endian 32-bit word: sample 2*i low, 2*i+1 high
+            u = b[:2*len(iq)].view('<u4')
+            try:
+                word, flag, code, tmp = self._scratch[len(u)]
+            except KeyError:
+                word = np.empty(len(u), dtype=np.uint32)
+                flag = np.empty(len(u), dtype=bool)
+                code = np.empty(len(u), dtype=np.uint32)
+                tmp = np.empty(len(u), dtype=np.float32)
+                self._scratch.clear()   # keep only the most recent size
+                self._scratch[len(u)] = (word, flag, code, tmp)
+            # strip control bits and scale the 12-bit ADC codes to [-1,+1]
+            for part, shift in ((iq.real, 16*ri), (iq.imag, 16*qi)):
+                np.right_shift(u, shift, out=code)
+                np.bitwise_and(code, 0xFFF, out=code)
+                np.multiply(code, _IQ_SCALE, out=tmp)
+                np.subtract(tmp, 1.0, out=part)
+            # control bit is set only on quadrature samples
+            np.bitwise_and(u, 0x10001000, out=word)
+            np.bitwise_xor(word, 0x1000 << (16*qi), out=word)
+            polarity_ok = not word.any()
+            # on-time-marker: flip to active-high, then the first marked pair is the argmax
+            np.bitwise_xor(u, 0x80008000 if otm_polarity else 0, out=word)
+            np.bitwise_and(word, 0x80008000, out=word)
+            np.not_equal(word, 0, out=flag)
+            otm_index = -1
+            if len(flag):
+                hit = int(flag.argmax())
+                if flag[hit]:
+                    otm_index = hit
+        if not polarity_ok:
             raise PolarityException('Expected {}...'.format('QIQI' if iq_polarity else 'IQIQ'))
-        iq /= (4095/2)
-        iq -= (1 + 1j)
-        otm_index = -1              # on-time-marker not found
-        if otm_polarity and otm.min()<1:
-            otm_index = int(otm.argmin()/2)
-        elif not otm_polarity and otm.max()>0:
-            otm_index = int(otm.argmax()/2)
         return iq, otm_index, (len(iq)-otm_index-1)*self.state.sps
 
     # Property-based interface to the object
     center_freq = property(_get_center_freq, _set_center_freq,
                     doc='set or get the center frequency of tuner (in Hz)')
+    reference_freq = property(_get_reference_freq, _set_reference_freq,
+                    doc='set or get the frequency of the TCXO reference (in Hz)')
     sample_rate = property(_get_sample_rate, _set_sample_rate,
                     doc='set or get the sample rate of the ADC (in Hz)')
     gain = property(_get_gain, _set_gain,
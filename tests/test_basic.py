@@ -1,5 +1,6 @@
 import pytest
 import sys,os
+import numpy as np
 
 def test():
     with pytest.warns(None) as record:
@@ -16,11 +17,164 @@ def test():
         sdr.gain        = 56.0     # dB
         sys.stdout.write(str(sdr)+'\n')
         # test unpacking subroutine
-        with open(os.path.join('tests','test.dat'),'r') as f:
-            buf = f.read()
-            iq = sdr._packed_bytes_to_iq(buf)
-            sys.stdout.write(str(iq)+'\n')
+        buf = np.fromfile(os.path.join('tests','test.dat'), dtype='<i2')
+        iq = sdr._packed_bytes_to_iq(buf)
+        sys.stdout.write(str(iq)+'\n')
+        batch = sdr._packed_bytes_to_iq_batch([buf, buf.tobytes()])
+        sys.stdout.write(str(batch)+'\n')
+        assert np.array_equal(batch[0], np.concatenate([iq[0], iq[0]]))
+        assert batch[1] == iq[1]
     return True
 
+def test_center_freq():
+    from pyrasdr.base import BaseRASDR, ParameterError
+    sdr = BaseRASDR(simulation=True)
+    sdr.center_freq = 400e6
+    assert sdr.state.tuner == { 'r':13, 'n':1 }
+    assert sdr.center_freq == 30.72e6*13
+    for f in (float('nan'), float('inf'), -float('inf')):
+        with pytest.raises(ParameterError):
+            sdr.center_freq = f
+    assert sdr.center_freq == 30.72e6*13
+
+def test_reference_freq():
+    from pyrasdr.base import BaseRASDR, ParameterError
+    sdr = BaseRASDR(simulation=True)
+    sdr.center_freq = 1420.4e6
+    sdr.reference_freq = 30.7201e6
+    assert sdr.reference_freq == 30.7201e6
+    assert sdr.center_freq == 30.7201e6*46
+    for f in (0.0, -30.72e6, float('nan'), float('inf')):
+        with pytest.raises(ParameterError):
+            sdr.reference_freq = f
+    assert sdr.reference_freq == 30.7201e6
+
+def test_gain():
+    from pyrasdr.base import BaseRASDR, ParameterError
+    sdr = BaseRASDR(simulation=True)
+    for g, stages in ((0.0,   [0.0, 0.0, 0.0]),
+                      (1.0,   [0.0, 1.0, 0.0]),
+                      (4.0,   [3.0, 1.0, 0.0]),
+                      (40.0,  [6.0, 25.17, 6.0]),
+                      (61.17, [6.0, 25.17, 30.0])):
+        sdr.gain = g
+        assert sdr.state.gain == pytest.approx(stages)
+    sdr.gain = 4.0
+    assert sdr.gain == pytest.approx(4.0)
+    for g in (float('nan'), -1.0, 61.2):
+        with pytest.raises(ParameterError):
+            sdr.gain = g
+
+def _packed_stream(code, iq_polarity):
+    '''Pack 12-bit codes (I,Q order) into words with the quadrature control bit set.'''
+    words = np.empty_like(code)
+    ri, qi = (1, 0) if iq_polarity else (0, 1)
+    words[ri::2] = code[0::2]
+    words[qi::2] = code[1::2] | 0x1000
+    return words
+
+def _check_unpack(sdr, base):
+    rng = np.random.RandomState(1420)
+    code = rng.randint(0, 4096, size=2*1000).astype('<i2')
+    expected = (code[0::2]*2.0/4095-1) + 1j*(code[1::2]*2.0/4095-1)
+    marker = np.int16(-0x8000)
+    for iq_polarity in (False, True):
+        words = _packed_stream(code, iq_polarity)
+        for otm_polarity in (False, True):
+            idle = (words | marker) if otm_polarity else words
+            iq, otm_index, _ = sdr._packed_bytes_to_iq(idle.tobytes(), iq_polarity, otm_polarity)
+            assert iq.dtype == np.complex64
+            assert np.allclose(iq, expected, rtol=0, atol=1e-6)
+            assert otm_index == -1
+            for k in (0, 377, 999):
+                for w in (2*k, 2*k+1):
+                    buf = idle.copy()
+                    buf[w] ^= marker
+                    buf[2*k+3:] ^= marker   # later markers must not matter
+                    iq, otm_index, _ = sdr._packed_bytes_to_iq(buf, iq_polarity, otm_polarity)
+                    assert otm_index == k
+        for w in (0, 1, 1234, 1235):
+            buf = words.copy()
+            buf[w] ^= 0x1000
+            with pytest.raises(base.PolarityException):
+                sdr._packed_bytes_to_iq(buf, iq_polarity)
+
+def test_unpack_numpy(monkeypatch):
+    from pyrasdr import base
+    monkeypatch.setattr(base, '_unpack_iq', None)
+    _check_unpack(base.BaseRASDR(simulation=True), base)
+
+def test_unpack_scratch(monkeypatch):
+    from pyrasdr import base
+    monkeypatch.setattr(base, '_unpack_iq', None)
+    sdr = base.BaseRASDR(simulation=True)
+    code = np.zeros(2*64, dtype='<i2')
+    for n in (64, 17, 40, 17):
+        sdr._packed_bytes_to_iq(_packed_stream(code[:2*n], False))
+        assert list(sdr._scratch) == [n]
+
+def test_unpack_array_input(monkeypatch):
+    from pyrasdr import base
+    sdr = base.BaseRASDR(simulation=True)
+    words = _packed_stream(np.arange(2*8, dtype='<i2'), False)
+    words[2*5] |= np.int16(-0x8000)     # OTM on sample 5
+    expected = sdr._packed_bytes_to_iq(words.tobytes())
+    padded = np.zeros(2*len(words), dtype='<i2')
+    padded[::2] = words
+    for kernel in set([base._unpack_iq, None]):
+        monkeypatch.setattr(base, '_unpack_iq', kernel)
+        for buf in (words, padded[::2], words.reshape(-1,2), words.view('<u4')):
+            iq, otm_index, _ = sdr._packed_bytes_to_iq(buf)
+            assert np.array_equal(iq, expected[0])
+            assert otm_index == expected[1] == 5
+
+def test_read_samples_into():
+    from pyrasdr import base
+    words = _packed_stream(np.arange(2*8, dtype='<i2'), False)
+    words[2*3+1] |= np.int16(-0x8000)   # OTM on sample 3
+    class Stub(base.BaseRASDR):
+        available = 8
+        def read(self, n=0):
+            return words[:self.available*2].tobytes()[:n]
+    sdr = Stub(simulation=True)
+    expected = sdr._packed_bytes_to_iq(words)[0]
+    out = np.zeros(8, np.complex64)
+    n, otm_index, offset = sdr.read_samples_into(out)
+    assert (n, otm_index) == (8, 3)
+    assert offset == pytest.approx(4*sdr.state.sps)
+    assert np.array_equal(out, expected)
+    sdr.available = 5
+    out[:] = 0
+    n, otm_index, offset = sdr.read_samples_into(out)
+    assert (n, otm_index) == (5, 3)
+    assert offset == pytest.approx(1*sdr.state.sps)
+    assert np.array_equal(out[:5], expected[:5])
+    assert not out[5:].any()
+    sdr.available = 0
+    assert sdr.read_samples_into(out)[:2] == (0, -1)
+    assert len(sdr.read_samples(8)) == 0
+    sdr.available = 8
+    assert np.array_equal(sdr.read_samples(8), expected)
+
+def test_unpack_batch():
+    from pyrasdr import base
+    sdr = base.BaseRASDR(simulation=True)
+    first = _packed_stream(np.arange(2*6, dtype='<i2'), False)
+    second = _packed_stream(np.arange(2*4, dtype='<i2') + 100, False)
+    second[2*2] |= np.int16(-0x8000)    # OTM on sample 2 of the second chunk
+    iq, otm_index, offset = sdr._packed_bytes_to_iq_batch([first.tobytes(), second])
+    assert np.array_equal(iq, np.concatenate([sdr._packed_bytes_to_iq(first)[0],
+                                              sdr._packed_bytes_to_iq(second)[0]]))
+    assert otm_index == 6 + 2
+    assert offset == pytest.approx(1*sdr.state.sps)
+    with pytest.raises(base.ParameterError):
+        sdr._packed_bytes_to_iq_batch([])
+
+def test_unpack_numba():
+    from pyrasdr import base
+    if base._unpack_iq is None:
+        pytest.skip('numba is not installed')
+    _check_unpack(base.BaseRASDR(simulation=True), base)
+
 if __name__ == '__main__':
     assert test()